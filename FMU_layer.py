@@ -37,10 +37,33 @@ class FMUCell(tf.keras.layers.Layer):
         learnable_parameters: list | set = None,
         step_size: float = 0.1,
         do_step_in_gradient: bool = False,
+        jacobian_update_interval: int = 1,
+        jacobian_update_threshold: float = None,
+        broyden_update: bool = False,
+        broyden_max_residual: float = 0.5,
+        jacobian_final_check: bool = False,
         **kwargs
     ):
+        """FMU recurrent cell
+        jacobian_update_interval: compute the exact Jacobian every k backward steps (1 = always exact)
+        jacobian_update_threshold: relative input/output change w.r.t. the last exact Jacobian that forces a recomputation
+        broyden_update: update the reused Jacobian with a Broyden rank-one correction from the observed input/output changes
+            between neighbouring timesteps. The secant assumes a constant FMU state: the output change also contains the
+            state evolution across the step, which the io Jacobian does not describe (e.g. an integrator on the path)
+        broyden_max_residual: skip the Broyden update when ||dy - J du|| > broyden_max_residual * ||dy||, i.e. when the
+            output change is not explained by the input change (state-driven)
+        jacobian_final_check: compute the exact Jacobian at the last backward step (first timestep) of each sequence if the
+            cached one is reused, so that the trailing reused block is measured as well
+        """
         super(FMUCell, self).__init__(**kwargs)
 
+        if jacobian_update_interval < 1:
+            raise ValueError(f"jacobian_update_interval must be >= 1. Got: {jacobian_update_interval}")
+        if jacobian_update_threshold is not None and jacobian_update_threshold < 0:
+            raise ValueError(f"jacobian_update_threshold must be >= 0. Got: {jacobian_update_threshold}")
+        if broyden_update and broyden_max_residual <= 0:
+            raise ValueError(f"broyden_max_residual must be > 0 when broyden_update is enabled. Got: {broyden_max_residual}")
+
         # instantiate the class
         self.fmu_model = FMU2_model(
             fmu_path,
@@ -57,6 +80,15 @@ class FMUCell(tf.keras.layers.Layer):
         self.state_size = 2 # state: [pointer value to the FMU state, FMU time]
         self.output_size = len(self.fmu_model.get_outputs())
 
+        # Jacobian reuse (approximate gradient)
+        self.jacobian_update_interval = jacobian_update_interval
+        self.jacobian_update_threshold = jacobian_update_threshold
+        self.broyden_update = broyden_update
+        self.broyden_max_residual = broyden_max_residual
+        self.jacobian_final_check = jacobian_final_check
+        self.reset_jacobian_cache()
+        self.reset_jacobian_error()
+
     def build(self, input_shape):
         self.input_size = input_shape[-1]
         self.built = True
@@ -87,26 +119,80 @@ class FMUCell(tf.keras.layers.Layer):
 
         def custom_grad(upstream):
 
-            def grad_step(upstream, state, inputs):
-                # set the FMU state
-                self.fmu_model.set_FMU_state_value(state[0,0], set_time=False)
-                if self.do_step_in_gradient:
-                    # do step to compute the directional derivative at the effective current state
-                    self.fmu_model.set_inputs(tf.unstack(tf.reshape(inputs, [-1])))
-                    self.fmu_model.do_step(self.dt)
-
-                # Compute the Jacobian with directional derivative
-                jacobian = tf.convert_to_tensor(
-                    self.fmu_model.get_directional_derivative_io(),
-                    dtype=tf.keras.backend.floatx(),
+            def grad_step(upstream, state, inputs, outputs):
+                u = tf.reshape(inputs, [-1])
+                y = tf.reshape(outputs, [-1])
+
+                # the first timestep (last backward step) starts from the constant initial state
+                last_step = float(state[0,1]) == self.start_time
+
+                needs_update = self.jacobian_needs_update(u, y) or (
+                    last_step and self.jacobian_final_check and self.jacobian_reused > 0
                 )
 
+                if self.broyden_update and not needs_update:
+                    # Broyden rank-one update from the input/output change w.r.t. the previous backward step
+                    du = u - self.last_inputs
+                    dy = y - self.last_outputs
+                    du_norm2 = tf.reduce_sum(du * du)
+                    if du_norm2 > 1e-12:
+                        residual = dy - tf.linalg.matvec(self.jacobian, du)
+                        residual_norm = float(tf.norm(residual))
+                        if residual_norm <= self.broyden_max_residual * float(tf.norm(dy)):
+                            self.jacobian += tf.tensordot(residual, du, axes=0) / du_norm2
+                            self.jacobian_error["secant_residual"] += residual_norm
+                            self.jacobian_error["broyden_updates"] += 1
+                        else:
+                            # output change dominated by the state evolution, keep the Jacobian as is
+                            self.jacobian_error["broyden_skipped"] += 1
+
+                if needs_update:
+                    # set the FMU state
+                    self.fmu_model.set_FMU_state_value(state[0,0], set_time=False)
+                    if self.do_step_in_gradient:
+                        # do step to compute the directional derivative at the effective current state
+                        self.fmu_model.set_inputs(tf.unstack(u))
+                        self.fmu_model.do_step(self.dt)
+
+                    # Compute the Jacobian with directional derivative
+                    jacobian = tf.convert_to_tensor(
+                        self.fmu_model.get_directional_derivative_io(),
+                        dtype=tf.keras.backend.floatx(),
+                    )
+
+                    # error of the reused Jacobian w.r.t. the exact one, weighted by the number of steps it was reused
+                    # (the cache only holds Jacobians of the current sequence)
+                    if self.jacobian_reused > 0:
+                        error = float(tf.norm(jacobian - self.jacobian))
+                        self.jacobian_error["accumulated"] += error * self.jacobian_reused
+                        self.jacobian_error["max"] = max(self.jacobian_error["max"], error)
+                        self.jacobian_error["measured"] += self.jacobian_reused
+
+                    self.jacobian = jacobian
+                    self.jacobian_age = 0
+                    self.jacobian_inputs = u
+                    self.jacobian_outputs = y
+                    self.jacobian_reused = 0
+                    self.jacobian_error["exact"] += 1
+                else:
+                    self.jacobian_reused += 1
+                    self.jacobian_error["reused"] += 1
+
+                if last_step:
+                    # trailing reused block of the sequence without an exact Jacobian to compare with
+                    self.jacobian_error["unmeasured"] += self.jacobian_reused
+                    self.jacobian_reused = 0
+
+                self.jacobian_age += 1
+                self.last_inputs = u
+                self.last_outputs = y
+
                 # Sum over the rows of the Jacobian matrix to get the gradient w.r.t. each input
-                grad = tf.reduce_sum(tf.transpose(upstream) * jacobian, axis=0)
+                grad = tf.reduce_sum(tf.transpose(upstream) * self.jacobian, axis=0)
                 return grad
 
             grad = tf.py_function(
-                grad_step, inp=[upstream, state, inputs], Tout=tf.keras.backend.floatx()
+                grad_step, inp=[upstream, state, inputs, outputs], Tout=tf.keras.backend.floatx()
             )
             return tf.reshape(grad, inputs.shape), None # TODO: add learnable parameters
 
@@ -115,6 +201,64 @@ class FMUCell(tf.keras.layers.Layer):
             custom_grad,
         )
 
+    def jacobian_needs_update(self, inputs, outputs):
+        """check if the exact Jacobian has to be recomputed at the current backward step"""
+
+        if self.jacobian is None or self.jacobian_age >= self.jacobian_update_interval:
+            return True
+        if self.jacobian_update_threshold is not None:
+            # relative change of inputs and outputs (proxy for the state change) since the last exact Jacobian
+            du = tf.norm(inputs - self.jacobian_inputs) / (tf.norm(self.jacobian_inputs) + 1e-12)
+            dy = tf.norm(outputs - self.jacobian_outputs) / (tf.norm(self.jacobian_outputs) + 1e-12)
+            if max(float(du), float(dy)) > self.jacobian_update_threshold:
+                return True
+        return False
+
+    def reset_jacobian_cache(self):
+        # drop the reused Jacobian, the next backward step computes an exact one
+        self.jacobian = None
+        self.jacobian_age = 0
+        self.jacobian_reused = 0
+        self.jacobian_inputs = None
+        self.jacobian_outputs = None
+        self.last_inputs = None
+        self.last_outputs = None
+
+    def start_sequence(self):
+        """reset the Jacobian cache at the beginning of a forward pass (run through tf.py_function, also in graph mode)"""
+
+        self.reset_jacobian_cache()
+        self.jacobian_error["sequences"] += 1
+        return tf.constant(True)
+
+    def reset_jacobian_error(self):
+        # reset the Jacobian approximation statistics
+        # NOTE: the error is sampled at each exact recomputation that follows reused steps (within a sequence) and
+        # weighted by the number of reused steps; the trailing reused block of each sequence is only measured with
+        # jacobian_final_check, otherwise it is counted in "unmeasured"
+        self.jacobian_error = {
+            "sequences": 0,         # number of forward passes (each one resets the Jacobian cache)
+            "exact": 0,             # number of exact Jacobian computations
+            "reused": 0,            # number of backward steps with a reused/updated Jacobian
+            "measured": 0,          # number of reused steps covered by an error sample
+            "unmeasured": 0,        # number of reused steps not covered by an error sample (trailing blocks)
+            "accumulated": 0.0,     # sum of ||J_exact - J_approx||_F * (number of steps J_approx was reused)
+            "max": 0.0,             # max of ||J_exact - J_approx||_F over the samples
+            "broyden_updates": 0,   # number of applied Broyden updates
+            "broyden_skipped": 0,   # number of Broyden updates skipped because of a large secant residual
+            "secant_residual": 0.0, # sum of ||dy - J du|| of the applied Broyden updates (assumes a constant FMU state)
+        }
+
+    def get_jacobian_error(self):
+        """get the Jacobian approximation statistics (see reset_jacobian_error for the meaning of the keys)
+        NOTE: the Broyden secant assumes a constant FMU state, "secant_residual" also contains the state evolution
+        "mean" is the per reused step mean of ||J_exact - J_approx||_F over the measured steps
+        """
+
+        error = dict(self.jacobian_error)
+        error["mean"] = error["accumulated"] / error["measured"] if error["measured"] > 0 else 0.0
+        return error
+
     def reset_states(self):
         # reset FMU states
         self.fmu_model.reset_FMU()
@@ -124,6 +268,11 @@ class FMUCell(tf.keras.layers.Layer):
         config.update(
             {
                 "state_size": self.state_size,
+                "jacobian_update_interval": self.jacobian_update_interval,
+                "jacobian_update_threshold": self.jacobian_update_threshold,
+                "broyden_update": self.broyden_update,
+                "broyden_max_residual": self.broyden_max_residual,
+                "jacobian_final_check": self.jacobian_final_check,
             }
         )
         return config
@@ -148,6 +297,11 @@ class FMULayer(tf.keras.layers.Layer):
         learnable_parameters: list | set = None,
         step_size: float = 0.1,
         do_step_in_gradient: bool = False,
+        jacobian_update_interval: int = 1,
+        jacobian_update_threshold: float = None,
+        broyden_update: bool = False,
+        broyden_max_residual: float = 0.5,
+        jacobian_final_check: bool = False,
         **kwargs
     ):
         super(FMULayer, self).__init__()
@@ -165,6 +319,11 @@ class FMULayer(tf.keras.layers.Layer):
             learnable_parameters,
             step_size,
             do_step_in_gradient=do_step_in_gradient,
+            jacobian_update_interval=jacobian_update_interval,
+            jacobian_update_threshold=jacobian_update_threshold,
+            broyden_update=broyden_update,
+            broyden_max_residual=broyden_max_residual,
+            jacobian_final_check=jacobian_final_check,
         )
 
         # set initial states
@@ -182,7 +341,34 @@ class FMULayer(tf.keras.layers.Layer):
 
     def call(self, inputs):
         self.cell.reset_states()
+        # reset the Jacobian cache inside the graph: call is only traced once by model.fit
+        new_sequence = tf.py_function(func=self.cell.start_sequence, inp=[], Tout=tf.bool)
+        with tf.control_dependencies([new_sequence]):
+            inputs = tf.identity(inputs)
         return self.rnn_layer(inputs, self.initial_state)
 
+    def get_jacobian_error(self):
+        """get the Jacobian approximation statistics of the FMU cell"""
+
+        return self.cell.get_jacobian_error()
+
+    def reset_jacobian_error(self):
+        """reset the Jacobian approximation statistics of the FMU cell"""
+
+        self.cell.reset_jacobian_error()
+
+    def get_config(self):
+        config = super().get_config().copy()
+        config.update(
+            {
+                "jacobian_update_interval": self.cell.jacobian_update_interval,
+                "jacobian_update_threshold": self.cell.jacobian_update_threshold,
+                "broyden_update": self.cell.broyden_update,
+                "broyden_max_residual": self.cell.broyden_max_residual,
+                "jacobian_final_check": self.cell.jacobian_final_check,
+            }
+        )
+        return config
+
     def compute_output_shape(self, input_shape):
         return (input_shape[0], input_shape[1], len(self.cell.fmu_model.get_outputs()))
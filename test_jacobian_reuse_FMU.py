@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@authors: Matteo Larcher
+"""
+"""
+Test Jacobian reuse in the FMU layer (speed/accuracy trade-off of the approximate gradient)
+"""
+
+#%% import libraries
+import os
+import math
+import time
+import numpy as np
+import tensorflow as tf
+
+# custom libraries
+from FMU_layer import *
+
+#%%
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#   ____             __ _
+#  / ___|___  _ __  / _(_) __ _ ___
+# | |   / _ \| '_ \| |_| |/ _` / __|
+# | |__| (_) | | | |  _| | (_| \__ \
+#  \____\___/|_| |_|_| |_|\__, |___/
+#                         |___/
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+# set keras float precision
+tf.keras.backend.set_floatx('float64')
+
+# run in graph mode (as model.fit does by default)
+tf.config.run_functions_eagerly(False)
+
+dirname = os.path.dirname(__file__)
+fmu_path = os.path.join(dirname, "fmu_model", "xy_model_om_dd_par.fmu")
+
+start_time = 0.0
+stop_time = 20.0
+step_size = 0.1
+t_vect = np.arange(start_time, stop_time, step_size)
+n_steps = len(t_vect)
+n_runs = 5
+epochs = 3
+max_rel_error = 0.2 # max relative gradient error accepted for the approximate modes
+
+start_values = {"x": 0.0, "y": 0.0}
+parameters = {"const.k": 1.0, "custom_parameter1.p": 1.0}
+learnable_parameters = {}
+
+input_x = np.cos(t_vect).reshape(1, -1, 1)
+input_y = np.sin(t_vect).reshape(1, -1, 1)
+input_data = tf.constant(np.concatenate([input_x, input_y], axis=2), dtype=tf.keras.backend.floatx())
+target = 4*((2*input_x+4*input_y+1) * (3*input_y-2*input_x-3)) + 2
+
+# approximate gradient modes to compare against the exact one
+modes = {
+    "exact": {},
+    "interval_5": {"jacobian_update_interval": 5},
+    "interval_5_broyden": {"jacobian_update_interval": 5, "broyden_update": True},
+    "interval_5_final_check": {"jacobian_update_interval": 5, "jacobian_final_check": True},
+    "interval_20_threshold": {"jacobian_update_interval": 20, "jacobian_update_threshold": 0.1},
+}
+
+def get_fmu_layer(name, **kwargs):
+    return FMULayer(
+        fmu_path,
+        start_time,
+        start_values,
+        parameters,
+        learnable_parameters,
+        step_size,
+        return_sequences=True,
+        return_state=False,
+        stateful=True,
+        name=name,
+        **kwargs,
+    )
+
+#%%
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#   ____               _ _            _
+#  / ___|_ __ __ _  __| (_) ___ _ __ | |_ ___
+# | |  _| '__/ _` |/ _` | |/ _ \ '_ \| __/ __|
+# | |_| | | | (_| | (_| | |  __/ | | | |_\__ \
+#  \____|_|  \__,_|\__,_|_|\___|_| |_|\__|___/
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+def get_layer_gradient(fmu_layer):
+    @tf.function
+    def layer_gradient(inputs):
+        with tf.GradientTape() as tape:
+            tape.watch(inputs)
+            outputs = fmu_layer(inputs)
+        return tape.gradient(outputs, inputs)
+    return layer_gradient
+
+# always-exact baseline
+baseline = get_layer_gradient(get_fmu_layer("baseline"))(input_data)
+
+gradients = {}
+for mode, kwargs in modes.items():
+    fmu_layer = get_fmu_layer(mode, **kwargs)
+    layer_gradient = get_layer_gradient(fmu_layer)
+
+    layer_gradient(input_data) # trace
+    fmu_layer.reset_jacobian_error()
+
+    tic = time.perf_counter()
+    for _ in range(n_runs):
+        gradients[mode] = layer_gradient(input_data)
+    elapsed = (time.perf_counter() - tic) / n_runs
+
+    stats = fmu_layer.get_jacobian_error()
+    rel_error = float(tf.norm(gradients[mode] - baseline) / tf.norm(baseline))
+    print(f"{mode:>25}: {elapsed*1e3:8.2f} ms/backward, relative gradient error {rel_error:.3e}, stats {stats}")
+
+    # the cache is reset at every forward pass, even if the layer call is traced only once
+    assert stats["sequences"] == n_runs, f"expected {n_runs} sequences, got {stats['sequences']}"
+    assert stats["exact"] + stats["reused"] == n_runs * n_steps, f"wrong number of backward steps: {stats}"
+    assert stats["measured"] + stats["unmeasured"] == stats["reused"], f"wrong number of measured steps: {stats}"
+
+    if mode == "exact":
+        assert rel_error < 1e-12, f"exact mode differs from the baseline: {rel_error}"
+        assert stats["reused"] == 0 and stats["accumulated"] == 0.0, f"exact mode reports an approximation: {stats}"
+        continue
+
+    assert stats["reused"] > 0, f"Jacobian never reused: {stats}"
+    assert rel_error < max_rel_error, f"relative gradient error too large: {rel_error}"
+
+    if "jacobian_update_threshold" not in kwargs:
+        interval = kwargs["jacobian_update_interval"]
+        trailing = (n_steps - 1) % interval # reused steps after the last exact Jacobian of each sequence
+        if kwargs.get("jacobian_final_check", False):
+            assert stats["exact"] == n_runs * (math.ceil(n_steps / interval) + (trailing > 0)), f"Jacobian leaked across sequences: {stats}"
+            assert stats["unmeasured"] == 0, f"trailing reused steps not measured: {stats}"
+        else:
+            assert stats["exact"] == n_runs * math.ceil(n_steps / interval), f"Jacobian leaked across sequences: {stats}"
+            assert stats["unmeasured"] == n_runs * trailing, f"wrong number of unmeasured steps: {stats}"
+
+    if kwargs.get("broyden_update", False):
+        assert stats["broyden_updates"] + stats["broyden_skipped"] > 0, f"Broyden update never run: {stats}"
+
+#%%
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#  _____ _ _
+# |  ___(_) |_
+# | |_  | | __|
+# |  _| | | |_
+# |_|   |_|\__|
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+# check that the cache does not leak across batches when model.fit runs in graph mode
+interval = 5
+x_in = tf.keras.layers.Input(shape=(None, 2), batch_size=1, name="xy_in")
+fmu_layer = get_fmu_layer("xy_fmu_fit", jacobian_update_interval=interval)
+z_out = fmu_layer(tf.keras.layers.TimeDistributed(tf.keras.layers.Dense(2), name="dense_before")(x_in))
+z_out_1 = tf.keras.layers.Lambda(lambda x: x[:,:,0:1], name="z_out_1", output_shape=(None,1))(z_out)
+model = tf.keras.Model(inputs=x_in, outputs=z_out_1)
+model.compile(optimizer=tf.keras.optimizers.Nadam(learning_rate=0.1), loss='mse')
+
+fmu_layer.reset_jacobian_error()
+model.fit(input_data, target, epochs=epochs, batch_size=1, shuffle=False, verbose=0)
+stats = fmu_layer.get_jacobian_error()
+print(f"fit ({epochs} epochs): {stats}")
+
+assert stats["sequences"] == epochs, f"expected {epochs} sequences, got {stats['sequences']}"
+assert stats["exact"] == epochs * math.ceil(n_steps / interval), f"Jacobian leaked across batches: {stats}"
+
+#%% check the Jacobian reuse settings are serialized with the layer and cell configs
+for config in [fmu_layer.get_config(), fmu_layer.cell.get_config()]:
+    assert config["jacobian_update_interval"] == interval
+    assert config["jacobian_update_threshold"] is None
+    assert config["broyden_update"] is False
+
+print("ALL DONE!")